@@ -1,21 +1,37 @@
+import copy
+import math
 import os
-from collections import defaultdict
-from datetime import datetime, timedelta
-from typing import Dict, List
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from typing import Dict, List, Optional
 
+import numpy as np
+import orjson
 import pandas as pd
 import plotly.express as px
 import requests
 import solara as sl
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
 # For hitting the API
 base_url = os.environ["DOMINO_KUBECOST_URL"]
-assets_url = sl.reactive(f"{base_url}/assets")
-allocations_url = sl.reactive(f"{base_url}/allocation")
+assets_url = f"{base_url}/assets"
+allocations_url = f"{base_url}/allocation"
 username = os.environ["DOMINO_KUBECOST_USERNAME"]
 pwd = os.environ["DOMINO_KUBECOST_PASSWORD"]
-auth = sl.reactive(HTTPBasicAuth(username, pwd))
+# A single pooled session so every re-render reuses warm keep-alive connections
+# instead of paying a fresh TCP+TLS handshake per request
+session = requests.Session()
+session.auth = HTTPBasicAuth(username, pwd)
+session.mount(base_url, HTTPAdapter(pool_connections=4, pool_maxsize=16))
+# Kubecost data moves on the minute timescale, so identical requests (same url,
+# window, filter and aggregate) within a minute are served from memory
+_response_cache = TTLCache(maxsize=64, ttl=60)
+_response_cache_lock = threading.Lock()
 
 # For interacting with the different scopes
 breakdown_options = ["Execution Type", "Top Projects", "User", "Organization"]
@@ -51,6 +67,37 @@ GLOBAL_FILTER_CHANGE_MAP = {
     "User": "Top Projects",
     "Execution Type": "User",
 }
+# Static skeleton of each breakdown chart. CostBreakdown fills in the title,
+# categories and bar data per render
+_BREAKDOWN_CHART_TEMPLATE = {
+    "title": {"text": ""},
+    "tooltip": {"trigger": "axis", "axisPointer": {"type": "shadow"}},
+    "legend": {},
+    "grid": {
+        "left": "3%",
+        "right": "4%",
+        "bottom": "3%",
+        "containLabel": True,
+    },
+    "xAxis": {"type": "value", "boundaryGap": [0, 0.01]},
+    "yAxis": {"type": "category", "data": []},
+    "series": [
+        {"type": "bar", "data": [], "stack": "y", "name": ""},
+        {"type": "bar", "data": [], "stack": "y", "color": "red", "name": ""},
+    ],
+}
+
+
+@cached(
+    _response_cache,
+    key=lambda url, params: hashkey(url, *sorted(params.items())),
+    lock=_response_cache_lock,
+)
+def _get_data(url: str, params: Dict) -> List[Dict]:
+    """Returns the "data" field of a Kubecost response. Shared, do not mutate"""
+    res = session.get(url, params=params)
+    # orjson parses the (often large) allocation payloads several times faster
+    return orjson.loads(res.content)["data"]
 
 
 def get_all_organizations() -> List[str]:
@@ -59,12 +106,24 @@ def get_all_organizations() -> List[str]:
         "aggregate": "label:dominodatalab_com_organization_name",
         "accumulate": True,
     }
-    orgs_res = requests.get(allocations_url.value, params=params, auth=auth.value)
-    orgs = orgs_res.json()["data"][0].keys()
+    orgs = _get_data(allocations_url, params)[0].keys()
     return [org for org in orgs if not org.startswith("__")]
 
 
-ALL_ORGS = [""] + get_all_organizations()
+# Fetched on first use, once per process, so importing the app doesn't block on
+# Kubecost and new sessions don't refetch it
+_all_orgs: Optional[List[str]] = None
+_all_orgs_lock = threading.Lock()
+
+
+def all_orgs() -> List[str]:
+    global _all_orgs
+    with _all_orgs_lock:
+        if _all_orgs is None:
+            _all_orgs = [""] + get_all_organizations()
+    return _all_orgs
+
+
 filtered_label = sl.reactive("")
 filtered_value = sl.reactive("")
 
@@ -78,6 +137,9 @@ def set_global_filters(click_data: Dict) -> None:
 def clear_filters() -> None:
     filtered_label.set("")
     filtered_value.set("")
+    # Clearing the filters doubles as a refresh
+    with _response_cache_lock:
+        _response_cache.clear()
 
 
 def set_filter(params: Dict) -> None:
@@ -86,161 +148,160 @@ def set_filter(params: Dict) -> None:
         params["filter"] = f'label[{param_label}]:"{filtered_value.value}"'
 
 
-def _format_datetime(dt_str: str) -> str:
-    datetime_object = datetime.strptime(dt_str, "%Y-%m-%dT%H:%M:%SZ")
-    return datetime_object.strftime("%m/%d %I:%M %p")
-
+def _base_params(aggregate: Optional[str] = None, accumulate: bool = True) -> Dict:
+    """Request params for the selected window and global filter
 
-def get_cost_per_breakdown(breakdown_for: str) -> Dict[str, float]:
-    params = {
-        "window": window_to_param[window_choice.value],
-        # "aggregate": f"label:{breakdown_to_param[breakdown_choice.value]}",
-        "aggregate": f"label:{breakdown_for}",
-        "accumulate": True,
-    }
+    Reads reactive state, so call it from the render thread and hand the result
+    to the fetchers
+    """
+    params = {"window": window_to_param[window_choice.value]}
+    if aggregate:
+        params["aggregate"] = aggregate
+    if accumulate:
+        params["accumulate"] = True
     set_filter(params)
+    return params
 
-    res = requests.get(allocations_url.value, params=params, auth=auth.value)
-    data = res.json()["data"][0]
-    return {
-        key: round(data[key]["totalCost"], 2)
-        for key in data
-        if not key.startswith("__")
-    }
 
+def _format_datetimes(dt_strs: pd.Series) -> pd.Series:
+    datetimes = pd.to_datetime(dt_strs, format="%Y-%m-%dT%H:%M:%SZ", utc=True)
+    return datetimes.dt.strftime("%m/%d %I:%M %p")
 
-def get_overall_cost() -> Dict[str, float]:
-    params = {
-        "window": window_to_param[window_choice.value],
-        "aggregate": "category",
-        "accumulate": True,
-    }
-    set_filter(params)
 
-    res = requests.get(assets_url.value, params=params, auth=auth.value)
+def _total_costs(data: Dict, keys: List[str]) -> Dict[str, float]:
+    """Maps each key to its totalCost, rounded to cents in one vectorized pass"""
+    costs = np.fromiter(
+        (data[key]["totalCost"] for key in keys), dtype=np.float64, count=len(keys)
+    ).round(2)
+    return dict(zip(keys, costs.tolist()))
+
 
-    data = res.json()["data"][0]
-    data.keys()
+def get_cost_per_breakdown(params: Dict) -> Dict[str, float]:
+    data = _get_data(allocations_url, params)[0]
+    return _total_costs(data, [key for key in data if not key.startswith("__")])
 
-    return {key: round(data[key]["totalCost"], 2) for key in data}
 
+def get_overall_cost(params: Dict) -> Dict[str, float]:
+    data = _get_data(assets_url, params)[0]
+    return _total_costs(data, list(data))
 
-def _to_date(date_string: str) -> str:
-    """Converts minute-level date string to day level
+
+def _to_dates(date_strings: pd.Index) -> pd.Index:
+    """Converts minute-level date strings to day level
 
     ex:
-       _to_date(2023-04-28T15:05:00Z) -> 2023-04-28
+       _to_dates([2023-04-28T15:05:00Z]) -> [2023-04-28]
     """
-    dt = datetime.strptime(date_string, "%Y-%m-%dT%H:%M:%SZ")
-    return dt.strftime("%Y-%m-%d")
-
+    dts = pd.to_datetime(date_strings, format="%Y-%m-%dT%H:%M:%SZ", utc=True)
+    return dts.strftime("%Y-%m-%d")
 
-def _add_day(date: str, days: int) -> str:
-    dt = datetime.strptime(date, "%Y-%m-%d")
-    dt_new = dt + timedelta(days=days)
-    return dt_new.strftime("%Y-%m-%d")
 
+def _add_day(day: str, days: int) -> str:
+    # fromisoformat is a C fast path that needs no format string, unlike strptime
+    dt_new = date.fromisoformat(day) + timedelta(days=days)
+    return dt_new.isoformat()
 
-def get_daily_cost() -> pd.DataFrame:
-    window = window_to_param[window_choice.value]
-    params = {
-        "window": window,
-        # "aggregate": "category",
-    }
-    set_filter(params)
 
-    # res = requests.get(assets_url.value, params=params, auth=auth.value)
-    res = requests.get(allocations_url.value, params=params, auth=auth.value)
-    data = res.json()["data"]
+def get_daily_cost(params: Dict) -> pd.DataFrame:
+    # res = session.get(assets_url, params=params)
+    data = _get_data(allocations_url, params)
     # May not have all historical days
     alocs = [day for day in data if day]
-    # Route returns data non-cumulatively. We make it cumulative by summing over the
-    # returned windows (could be days, hours, weeks etc)
-    daily_costs = defaultdict(dict)
-
     cpu_costs = ["cpuCost", "cpuCostAdjustment"]
     gpu_costs = ["gpuCost", "gpuCostAdjustment"]
     storage_costs = ["pvCost", "pvCostAdjustment", "ramCost", "ramCostAdjustment"]
 
     costs = {"CPU": cpu_costs, "GPU": gpu_costs, "Storage": storage_costs}
-    # Gets the overall cost per day
-    for aloc in alocs:
-        for key, values in aloc.items():
-            start = values["start"]
-            for cost_type, cost_keys in costs.items():
-                if cost_type not in daily_costs[start]:
-                    daily_costs[start][cost_type] = 0.0
-                daily_costs[start][cost_type] += round(
-                    sum(values[key] for key in cost_keys), 2
-                )
-    # Cumulative sum over the daily costs
-    df = pd.DataFrame(daily_costs).T.sort_index()
-    df["CPU"] = df["CPU"].cumsum()
-    df["GPU"] = df["GPU"].cumsum()
-    df["Storage"] = df["Storage"].cumsum()
+    # One row per allocation per returned window, keeping only the fields we need
+    records = pd.DataFrame(
+        [values for aloc in alocs for values in aloc.values()],
+        columns=["start", *cpu_costs, *gpu_costs, *storage_costs],
+    )
+    # Route returns data non-cumulatively. We make it cumulative by summing over the
+    # returned windows (could be days, hours, weeks etc). Reducing to one row per
+    # window before combining cost columns keeps the per-row work to a single groupby
+    per_window = records.groupby("start").sum()
+    df = (
+        pd.DataFrame(
+            {
+                cost_type: per_window[cost_keys].sum(axis=1)
+                for cost_type, cost_keys in costs.items()
+            }
+        )
+        .rename_axis(None)
+        .cumsum()
+    )
     # Unless we are looking at today granularity, rollup values to the day level
     # (they are returned at the 5min level)
-    if window != "today":
-        df.index = df.index.map(_to_date)
+    if params["window"] != "today":
+        df.index = _to_dates(df.index)
         df = df.groupby(level=0).max()
-    return df
+    return df.round(2)
 
 
 def get_execution_cost_table() -> pd.DataFrame:
     # TODO: Break down further by execution id
     # label:dominodatalab_com_execution_id
-    params = {
-        "window": window_to_param[window_choice.value],
-        "aggregate": (
-            "label:dominodatalab_com_workload_id,"  # TODO: workload_id or execution_id
-            "label:dominodatalab_com_workload_type,"
-            "label:dominodatalab_com_starting_user_username,"
-            "label:dominodatalab_com_project_id"
-        ),
-        "accumulate": True,
-    }
-    set_filter(params)
-
-    res = requests.get(allocations_url.value, params=params, auth=auth.value)
-    aloc_data = res.json()["data"][0]
+    params = _base_params(
+        "label:dominodatalab_com_workload_id,"  # TODO: workload_id or execution_id
+        "label:dominodatalab_com_workload_type,"
+        "label:dominodatalab_com_starting_user_username,"
+        "label:dominodatalab_com_project_id"
+    )
 
-    exec_data = []
+    aloc_data = _get_data(allocations_url, params)[0]
 
     cpu_cost_key = ["cpuCost", "gpuCost"]
     gpu_cost_key = ["cpuCostAdjustment", "gpuCostAdjustment"]
     storage_cost_keys = ["pvCost", "ramCost", "pvCostAdjustment", "ramCostAdjustment"]
 
-    keys = list(aloc_data.keys())
-    keys = [key for key in keys if not key.startswith("__")]
-    for key in keys:
-        workload_id, workload_type, uname, project_id = key.split("/")
-        # workload_id="foobar"
-        # workload_type, uname, project_id = key.split("/")
-        key_data = aloc_data[key]
-        cpu_cost = round(sum([key_data[k] for k in cpu_cost_key]), 2)
-        gpu_cost = round(sum([key_data[k] for k in gpu_cost_key]), 2)
-        compute_cost = round(cpu_cost + gpu_cost, 2)
-        storage_cost = round(sum([key_data[k] for k in storage_cost_keys]), 2)
-        waste = f"{((1-key_data['totalEfficiency'])*100)}%"
-        exec_data.append(
-            {
-                "TYPE": workload_type,
-                "USER": uname,
-                "START": key_data["start"],
-                "END": key_data["end"],
-                "CPU_COST": f"${cpu_cost}",
-                "GPU_COST": f"${gpu_cost}",
-                "COMPUTE_COST": f"${compute_cost}",
-                "COMPUTE_WASTE": waste,
-                "STORAGE_COST": f"${storage_cost}",
-                "WORKLOAD_ID": workload_id,
-                "PROJECT_ID": project_id,
-            }
-        )
-    df = pd.DataFrame(exec_data)
-    for col in ["START", "END"]:
-        if col in df.columns:
-            df[col] = df[col].apply(_format_datetime)
+    keys = [key for key in aloc_data if not key.startswith("__")]
+    if not keys:
+        return pd.DataFrame()
+    # Only pull the fields we use out of each (large, nested) allocation record
+    alocs = pd.DataFrame.from_records(
+        [aloc_data[key] for key in keys],
+        index=keys,
+        columns=[
+            "start",
+            "end",
+            "totalEfficiency",
+            *cpu_cost_key,
+            *gpu_cost_key,
+            *storage_cost_keys,
+        ],
+    )
+    # Keys are the aggregated labels, in the order they were requested
+    labels = alocs.index.to_series().str.split("/", expand=True)
+    labels.columns = ["WORKLOAD_ID", "TYPE", "USER", "PROJECT_ID"]
+
+    costs = pd.DataFrame(
+        {
+            "CPU_COST": alocs[cpu_cost_key].sum(axis=1),
+            "GPU_COST": alocs[gpu_cost_key].sum(axis=1),
+            "STORAGE_COST": alocs[storage_cost_keys].sum(axis=1),
+        }
+    ).round(2)
+    # Summed after rounding so it matches the CPU and GPU columns shown next to it
+    costs["COMPUTE_COST"] = costs["CPU_COST"] + costs["GPU_COST"]
+    for col in costs.columns:
+        costs[col] = costs[col].map("${:.2f}".format)
+    waste = (1 - alocs["totalEfficiency"]) * 100
+    df = pd.DataFrame(
+        {
+            "TYPE": labels["TYPE"],
+            "USER": labels["USER"],
+            "START": _format_datetimes(alocs["start"]),
+            "END": _format_datetimes(alocs["end"]),
+            "CPU_COST": costs["CPU_COST"],
+            "GPU_COST": costs["GPU_COST"],
+            "COMPUTE_COST": costs["COMPUTE_COST"],
+            "COMPUTE_WASTE": waste.map("{:.1f}%".format),
+            "STORAGE_COST": costs["STORAGE_COST"],
+            "WORKLOAD_ID": labels["WORKLOAD_ID"],
+            "PROJECT_ID": labels["PROJECT_ID"],
+        }
+    ).reset_index(drop=True)
     return df
 
 
@@ -251,8 +312,7 @@ def Executions() -> None:
 
 
 @sl.component()
-def DailyCostBreakdown() -> None:
-    df = get_daily_cost()
+def DailyCostBreakdown(df: pd.DataFrame) -> None:
     fig = px.bar(
         df,
         labels={
@@ -291,12 +351,11 @@ def SingleCost(name: str, cost: float) -> None:
 
 
 @sl.component()
-def TopLevelCosts() -> None:
-    costs = get_overall_cost()
+def TopLevelCosts(costs: Dict[str, float]) -> None:
     # with sl.Columns([2, 1, 1, 1]):
     with sl.Row(justify="space-around"):
         # with sl.Card():
-        SingleCost("Total", round(sum(list(costs.values())), 2))
+        SingleCost("Total", round(math.fsum(costs.values()), 2))
         for name, cost in costs.items():
             # with sl.Card():
             SingleCost(name, cost)
@@ -304,54 +363,47 @@ def TopLevelCosts() -> None:
 
 @sl.component()
 def OverallCosts() -> None:
+    # Both charts' data is fetched together up front and handed down to them
+    with ThreadPoolExecutor(2) as executor:
+        costs = executor.submit(get_overall_cost, _base_params("category"))
+        daily_costs = executor.submit(get_daily_cost, _base_params(accumulate=False))
     with sl.Column():
         with sl.Card():
-            TopLevelCosts()
+            TopLevelCosts(costs.result())
         with sl.Card():
-            DailyCostBreakdown()
+            DailyCostBreakdown(daily_costs.result())
 
 
 @sl.component()
 def CostBreakdown() -> None:
     # with sl.Row(gap="1px", justify="space-around"):
     with sl.Card("Cost Usage"):
+        # Fire all breakdown requests at once, then render them in order. The pool is
+        # per render so concurrent sessions never queue behind each other
+        with ThreadPoolExecutor(len(breakdown_to_param)) as executor:
+            futures = {
+                name: executor.submit(
+                    get_cost_per_breakdown, _base_params(f"label:{breakdown_choice_}")
+                )
+                for name, breakdown_choice_ in breakdown_to_param.items()
+            }
         with sl.Columns([1, 1, 1]):
-            for name, breakdown_choice_ in breakdown_to_param.items():
+            for name in breakdown_to_param:
                 # with sl.Card(f"Cost Usage - {name}", margin=10):
                 # sl.Select(label="", value=breakdown_choice, values=breakdown_options)
-                costs = get_cost_per_breakdown(breakdown_choice_)
+                costs = futures[name].result()
                 cost_values = list(costs.values())
                 max_spend = BREAKDOWN_SPEND_MAP.get(name, 1e1000)
                 overflow_values = [v - max_spend for v in cost_values]
                 overflow_values = [max(v, 0) for v in overflow_values]
-                option = {
-                    "title": {"text": name},
-                    "tooltip": {"trigger": "axis", "axisPointer": {"type": "shadow"}},
-                    "legend": {},
-                    "grid": {
-                        "left": "3%",
-                        "right": "4%",
-                        "bottom": "3%",
-                        "containLabel": True,
-                    },
-                    "xAxis": {"type": "value", "boundaryGap": [0, 0.01]},
-                    "yAxis": {"type": "category", "data": list(costs.keys())},
-                    "series": [
-                        {
-                            "type": "bar",
-                            "data": cost_values,
-                            "stack": "y",
-                            "name": name,
-                        },
-                        {
-                            "type": "bar",
-                            "data": overflow_values,
-                            "stack": "y",
-                            "color": "red",
-                            "name": name,
-                        },
-                    ],
-                }
+                option = copy.deepcopy(_BREAKDOWN_CHART_TEMPLATE)
+                option["title"]["text"] = name
+                option["yAxis"]["data"] = list(costs.keys())
+                for series, data in zip(
+                    option["series"], [cost_values, overflow_values]
+                ):
+                    series["data"] = data
+                    series["name"] = name
                 sl.FigureEcharts(option, on_click=set_global_filters)
 
 
@@ -370,7 +422,9 @@ def Page() -> None:
                     f"{filtered_label.value}: {filtered_value.value} x",
                     on_click=clear_filters,
                 )
-            # sl.Select(label="Organization", value=filtered_value, values=ALL_ORGS)
+            # sl.Select(
+            #     label="Organization", value=filtered_value, values=all_orgs()
+            # )
     # with sl.Columns([2, 3]):
     #     CostBreakdown()
     #     OverallCosts()